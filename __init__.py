@@ -0,0 +1,26 @@
+'''
+pysnippets : このディレクトリをパッケージとして使うためのもの
+
+    from pysnippets import files         # files だけ読み込まれる
+    import pysnippets
+    pysnippets.sub_process.bash_command_x('ls')
+
+サブモジュールは最初に属性としてアクセスされたときに import する (PEP 562)．
+cv2, matplotlib などの重い依存は，それを使うサブモジュールを触るまで読み込まれない．
+'''
+
+import importlib
+
+__all__ = [ 'cv2draw', 'cv2plt_videowrite', 'cv2video',
+            'files', 'fileindex', 'profiling', 'sub_process' ]
+
+
+def __getattr__(name):
+    if name in __all__:
+        module = importlib.import_module('.'+name, __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError('module %r has no attribute %r'%(__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
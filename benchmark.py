@@ -0,0 +1,256 @@
+'''
+各モジュールの重い処理のベンチマーク
+
+    python benchmark.py run -o result.json                # 計測して JSON に書く
+    python benchmark.py compare baseline.json result.json # baseline より遅くなったものを表示
+    python benchmark.py imports --budget-ms 100           # 軽いモジュールの import 時間の確認
+
+- テスト用の動画・ディレクトリツリー・コマンドはその場で一時ディレクトリに作る
+- 各ベンチマークは新しいプロセス (spawn) で repeat 回実行して中央値をとる
+  (ピークメモリ peak_rss_kb もそのプロセスのもの)
+- compare は threshold (既定 10%) 以上悪くなったものを REGRESSION として表示し，終了コード 1 を返す
+- imports は LIGHT_MODULES をパッケージ経由 (import pysnippets.files など) で新しいインタプリタで
+  import した時間 (pysnippets/__init__.py の分も含む) が budget を超えるか，
+  cv2 などの重い依存を読み込んでいたら OVER として表示し，終了コード 1 を返す
+  (インストールされたものではなく，この benchmark.py があるディレクトリを pysnippets として読む)
+'''
+
+import os
+import io
+import sys
+import importlib
+import json
+import time
+import resource
+import argparse
+import subprocess
+import platform
+import tempfile
+import statistics
+import contextlib
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+# パッケージ (pysnippets.benchmark) としても，このディレクトリでスクリプトとしても使えるように
+def _module(name):
+    if __package__:
+        return importlib.import_module('.'+name, __package__)
+    return importlib.import_module(name)
+
+
+### fixtures ###################################################################
+
+def make_video(root, T=300, H=240, W=320):
+    cv2draw = _module('cv2draw')
+    cv2plt_videowrite = _module('cv2plt_videowrite')
+    t = np.arange(T)*2*np.pi/30
+    vbos = np.stack([W/2+W/3*np.cos(t), H/2+H/3*np.sin(t)],axis=1)[:,None,:]
+    frames = cv2draw.render_video( vbos, H,W, ibo_=np.array([0]), radius=8 )
+    path = root/'video.mp4'
+    with contextlib.redirect_stderr(io.StringIO()):
+        cv2plt_videowrite.write_video( frames, path )
+    return path
+
+def make_tree(root, depth=3, fanout=6, files=20):
+    def fill(d, level):
+        d.mkdir(parents=True,exist_ok=True)
+        for i in range(files):
+            (d/('%03d.%s'%(i,'png' if i%2 else 'txt'))).touch()
+        if level < depth:
+            for i in range(fanout):
+                fill(d/('d%d'%i), level+1)
+    fill(root/'tree', 0)
+    return root/'tree'
+
+
+### benchmarks #################################################################
+# それぞれ ( 値, 単位, 大きい方が良いか ) を返す
+
+def bench_read_video(path):
+    cv2video = _module('cv2video')
+    start = time.perf_counter()
+    frames = cv2video.read_video(path)
+    return len(frames)/(time.perf_counter()-start), 'frames/s', True
+
+def bench_read_video3(path):
+    cv2video = _module('cv2video')
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        status, frames = cv2video.read_video3(path, slice(None,None,10))
+    return len(frames)/(time.perf_counter()-start), 'frames/s', True
+
+def bench_videoframes(H=240, W=320, T=30):
+    cv2plt_videowrite = _module('cv2plt_videowrite')
+    frames = cv2plt_videowrite.VideoFrames(np.arange(T)*0.2, H,W)
+    start = time.perf_counter()
+    [ frames[i] for i in range(T) ]
+    return T/(time.perf_counter()-start), 'frames/s', True
+
+def bench_videoframes_agg(H=240, W=320, T=300):
+    cv2plt_videowrite = _module('cv2plt_videowrite')
+    frames = cv2plt_videowrite.VideoFramesAgg(np.arange(T)*0.2, H,W)
+    start = time.perf_counter()
+    [ frames[i] for i in range(T) ]
+    return T/(time.perf_counter()-start), 'frames/s', True
+
+def bench_cv2draw(N=100000, H=1000, W=1000):
+    cv2draw = _module('cv2draw')
+    rng = np.random.default_rng(0)
+    vbo = rng.uniform(0, W, (N*3,2))
+    renderer = cv2draw.Renderer(H,W)
+    start = time.perf_counter()
+    renderer.points(vbo, np.arange(N))
+    renderer.lines(vbo, np.arange(2*N).reshape(-1,2)%len(vbo))
+    return 2*N/(time.perf_counter()-start), 'primitives/s', True
+
+def bench_findAR(tree):
+    files = _module('files')
+    start = time.perf_counter()
+    n = len(files.findAR(tree, r'\.png$'))+len(files.findAR(tree, r'/d1$'))
+    return n/(time.perf_counter()-start), 'matches/s', True
+
+def bench_find(tree):
+    files = _module('files')
+    start = time.perf_counter()
+    n = sum(1 for _ in files.find(tree, r'\.png$'))+sum(1 for _ in files.find(tree, r'/d1$'))
+    return n/(time.perf_counter()-start), 'matches/s', True
+
+def bench_bash_command_x(n=50):
+    sub_process = _module('sub_process')
+    start = time.perf_counter()
+    [ sub_process.bash_command_x('true') for _ in range(n) ]
+    return (time.perf_counter()-start)/n*1e3, 'ms/call', False
+
+
+# ピークメモリ [KB]．ru_maxrss は exec 前 (fork 元) の値を引き継ぐので，linux では VmHWM を使う
+def peak_rss_kb():
+    try:
+        for line in Path('/proc/self/status').read_text().splitlines():
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss//1024 if sys.platform == 'darwin' else maxrss
+
+def _measure(name, args):
+    value, unit, higher = globals()[name](*args)
+    return value, unit, higher, peak_rss_kb()
+
+
+def run(repeat=3):
+    spawn = multiprocessing.get_context('spawn')
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        root = Path(root)
+        video = make_video(root)
+        tree = make_tree(root)
+        benchmarks = [ ('bench_read_video',(video,)), ('bench_read_video3',(video,)),
+                       ('bench_videoframes',()), ('bench_videoframes_agg',()),
+                       ('bench_cv2draw',()), ('bench_findAR',(tree,)), ('bench_find',(tree,)),
+                       ('bench_bash_command_x',()) ]
+        for name,args in benchmarks:
+            values, rss = [], []
+            for _ in range(repeat):
+                # 毎回新しいプロセスで計る (import やメモリの影響を残さない)
+                with ProcessPoolExecutor(1, mp_context=spawn) as executor:
+                    value, unit, higher, maxrss = executor.submit(_measure, name, args).result()
+                values += [value]
+                rss += [maxrss]
+            key = name[len('bench_'):]
+            results[key] = { 'value': statistics.median(values), 'unit': unit,
+                             'higher_is_better': higher, 'peak_rss_kb': max(rss) }
+            print('%-20s %12.2f %-12s peak %d KB'%(key, results[key]['value'], unit, max(rss)))
+    meta = { 'python': sys.version.split()[0], 'platform': platform.platform(),
+             'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S') }
+    return {'meta': meta, 'results': results}
+
+
+def compare(baseline, result, threshold=0.1):
+    regressed = False
+    for name,new in result['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            print('%-20s %12.2f %-12s (new)'%(name, new['value'], new['unit']))
+            continue
+        ratio = new['value']/old['value'] if old['value'] else float('inf')
+        # 良くなった割合 (正なら改善，負なら悪化)
+        change = ratio-1 if new['higher_is_better'] else 1-ratio
+        flag = 'REGRESSION' if change < -threshold else ''
+        regressed |= bool(flag)
+        print('%-20s %12.2f -> %12.2f %-12s %+7.1f%% %s'%(name, old['value'], new['value'],
+                                                          new['unit'], change*100, flag))
+    return regressed
+
+
+### import time budget #########################################################
+
+LIGHT_MODULES = [ 'files', 'sub_process', 'fileindex', 'profiling' ]
+HEAVY_DEPENDENCIES = [ 'cv2', 'numpy', 'matplotlib', 'tqdm' ]
+
+# このディレクトリを pysnippets パッケージとして読み込み，import pysnippets.<module> にかかる時間 [ms] を表示する
+IMPORT_CODE = '''
+import sys, time, importlib.util
+root = %r
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location( 'pysnippets', root+'/__init__.py',
+                                               submodule_search_locations=[root] )
+package = importlib.util.module_from_spec(spec)
+sys.modules['pysnippets'] = package
+spec.loader.exec_module(package)
+import pysnippets.%s
+print((time.perf_counter()-start)*1e3, *[m for m in %r if m in sys.modules])
+'''
+
+# 新しいインタプリタで pysnippets.<module> を import したときの時間 [ms] (repeat 回の最小) と読み込まれた重い依存
+def import_time_ms(module, repeat=5):
+    code = IMPORT_CODE%(str(Path(__file__).resolve().parent), module, HEAVY_DEPENDENCIES)
+    times = []
+    for _ in range(repeat):
+        result = subprocess.run( [sys.executable, '-c', code], cwd=tempfile.gettempdir(),
+                                 capture_output=True, text=True, check=True )
+        ms, *heavy = result.stdout.split()
+        times += [float(ms)]
+    return min(times), heavy
+
+def check_imports(budget_ms):
+    over = False
+    for module in LIGHT_MODULES:
+        ms, heavy = import_time_ms(module)
+        flag = 'OVER' if ms > budget_ms or heavy else ''
+        over |= bool(flag)
+        print('%-20s %8.1f ms %s %s'%('pysnippets.'+module, ms, ' '.join(heavy), flag))
+    return over
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='mode', required=True)
+    p = sub.add_parser('run')
+    p.add_argument('-o', '--output', type=Path)
+    p.add_argument('--repeat', type=int, default=3)
+    p = sub.add_parser('compare')
+    p.add_argument('baseline', type=Path)
+    p.add_argument('result', type=Path)
+    p.add_argument('--threshold', type=float, default=0.1)
+    p = sub.add_parser('imports')
+    p.add_argument('--budget-ms', type=float, default=100.0)
+    args = parser.parse_args()
+
+    if args.mode == 'run':
+        result = run(args.repeat)
+        if args.output:
+            args.output.write_text(json.dumps(result, indent=2))
+    elif args.mode == 'imports':
+        sys.exit(1 if check_imports(args.budget_ms) else 0)
+    else:
+        regressed = compare( json.loads(args.baseline.read_text()),
+                             json.loads(args.result.read_text()), args.threshold )
+        sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__': main()
@@ -9,30 +9,140 @@ OpenCVの描画関数についてまとめた
 
 ( s:= start, m:= mid, g:= goal )
 
-TODO) クリッピング処理
+Renderer でまとめて描画する
+- 頂点の取り出しは vbo[ibo] の fancy indexing で一度に行う (M,K,2)
+- 画面外にあるプリミティブは描画前に捨てる (クリッピング)
+- 点 : numpy で円のステンシルを全点ぶん一度に書き込む
+- 線 : cv2.polylines を 1 回だけ呼ぶ
+- 面 : cv2.fillPoly に複数ポリゴンを渡すと重なった部分が XOR で抜けるので，
+       三角形ごとに cv2.fillConvexPoly を呼ぶ (1 個あたり数 us)
+
+頂点が時間で動く場合 VBO2 の代わりに (T,N,2_xy) を渡す
+- render_video   : (T,H,W,C) の uint8 配列に全フレームを描く (フレームごとにスレッドで並列)
+- RenderedFrames : chunk フレームずつ描きながら write_video に渡せるフレーム列
+どちらもプリミティブの外接矩形の中しか触らないので，H*W の計算は毎フレームのクリアだけ
 '''
 
-H,W,C = (128,128,3)
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+
+
+class Renderer:
+    def __init__(self, H,W,C=3):
+        self.shape = (H,W,C)
+        self.img = np.zeros(self.shape,dtype=np.uint8)
+
+    def clear(self):
+        self.img[...] = 0
+        return self.img
+
+    # prims (M,K,2_xy) のうち，外接矩形が画面 (の margin 外側まで) にかかっているものだけ残す
+    def cull(self, prims, margin=0):
+        H,W,C = self.shape
+        lo = prims.min(axis=1)
+        hi = prims.max(axis=1)
+        keep = (hi[:,0]>=-margin) & (hi[:,1]>=-margin) & (lo[:,0]<W+margin) & (lo[:,1]<H+margin)
+        return prims[keep]
+
+    # 点の描画 VBO2とIBO_を利用
+    def points(self, vbo, ibo, color=(255,255,255), radius=2, img=None):
+        img = self.img if img is None else img
+        H,W,C = self.shape
+        pts = self.cull(vbo[ibo].astype(np.int32)[:,None,:], radius)[:,0]
+        r = int(radius)
+        dy,dx = np.mgrid[-r:r+1,-r:r+1]
+        disc = (dx**2+dy**2) <= r**2
+        xs = (pts[:,0,None]+dx[disc][None,:]).ravel()
+        ys = (pts[:,1,None]+dy[disc][None,:]).ravel()
+        inside = (xs>=0) & (xs<W) & (ys>=0) & (ys<H)
+        # cv2 の描画関数と同じく，color は先頭 C 個を使い，足りない分は 0
+        value = np.zeros(C, dtype=img.dtype)
+        channels = np.ravel(color)[:C]
+        value[:len(channels)] = channels
+        img[ys[inside],xs[inside]] = value
+        return img
+
+    # 線の描画 VBO2とIBO2を利用
+    def lines(self, vbo, ibo, color=(255,255,255), thickness=1, lineType=cv2.LINE_AA, img=None):
+        img = self.img if img is None else img
+        segs = self.cull(vbo[ibo].astype(np.int32), thickness)
+        if len(segs):
+            cv2.polylines( img, segs, isClosed=False, color=color,
+                            thickness=thickness, lineType=lineType, shift=0)
+        return img
+
+    # 面の描画 VBO2とIBO3を利用
+    def polygons(self, vbo, ibo, color=(255,255,255), lineType=cv2.LINE_AA, img=None):
+        img = self.img if img is None else img
+        for poly in self.cull(vbo[ibo].astype(np.int32), 1):
+            cv2.fillConvexPoly( img, poly, color=color, lineType=lineType, shift=0)
+        return img
+
+
+# 1 フレーム分を frame に描く (面 → 線 → 点 の順)
+def _draw_frame(renderer, frame, vbo, ibo_, ibo2, ibo3, color, radius, thickness):
+    frame[...] = 0
+    if ibo3 is not None:
+        renderer.polygons(vbo, ibo3, color=color, img=frame)
+    if ibo2 is not None:
+        renderer.lines(vbo, ibo2, color=color, thickness=thickness, img=frame)
+    if ibo_ is not None:
+        renderer.points(vbo, ibo_, color=color, radius=radius, img=frame)
+    return frame
+
+# vbos (T,N,2_xy) を (T,H,W,C) に描く．out を渡すとそこに書き込む
+# cv2 の描画関数は GIL を離すのでスレッドで並列になる
+def render_video(vbos, H,W,C=3, ibo_=None, ibo2=None, ibo3=None, out=None, workers=None,
+                    color=(255,255,255), radius=2, thickness=1):
+    T = len(vbos)
+    out = np.empty((T,H,W,C),dtype=np.uint8) if out is None else out
+    renderer = Renderer(H,W,C)
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map( lambda t: _draw_frame(renderer, out[t], vbos[t], ibo_, ibo2, ibo3,
+                                                    color, radius, thickness), range(T) ))
+    return out
+
+# write_video にそのまま渡せるフレーム列．chunk フレームずつ render_video で描く
+# (書き出し側のキューが参照を持つので，chunk ごとに新しい配列を確保する)
+class RenderedFrames:
+    def __init__(self, vbos, H,W,C=3, chunk=64, **kwargs):
+        self.vbos = vbos
+        self.chunk = chunk
+        self.kwargs = kwargs
+        self.shape = (len(vbos),H,W,C)
+    def __len__(self):
+        return len(self.vbos)
+    def __getitem__(self,idx):
+        T,H,W,C = self.shape
+        if idx < 0:
+            idx += T
+        if not 0 <= idx < T:
+            raise IndexError('frame index out of range')
+        return render_video(self.vbos[idx:idx+1], H,W,C, workers=1, **self.kwargs)[0]
+    def chunks(self):
+        T,H,W,C = self.shape
+        for start in range(0, T, self.chunk):
+            yield render_video(self.vbos[start:start+self.chunk], H,W,C, **self.kwargs)
+    def __iter__(self):
+        for frames in self.chunks():
+            yield from frames
+
 
-vbo2 = np.array([[20,30],[40,70],[69,70],[100,100]])
-ibo_ = np.array([0,1,2])
-ibo2 = np.array([[0,1],[1,2],[2,0]])
-ibo3 = np.array([[0,1,2],[2,1,3]])
+def main():
+    H,W,C = (128,128,3)
 
+    vbo2 = np.array([[20,30],[40,70],[69,70],[100,100]])
+    ibo_ = np.array([0,1,2])
+    ibo2 = np.array([[0,1],[1,2],[2,0]])
+    ibo3 = np.array([[0,1,2],[2,1,3]])
 
-# 点の描画 VBO2とIBO_を利用
-points = [(vbo[idx,0],vbo[idx,1]) for vbo in [vbo2.astype(np.int32)] for idx in ibo_]
-rendered = [ l.append( cv2.circle( l.pop(0), pt, radius=2,color=(255,255,255),
-                        thickness=-1,lineType=cv2.LINE_8,shift=0)) if pt else l[0]
-            for l in [[np.zeros((H,W,C),dtype=np.uint8)]] for pt in points+[None] ][-1]
+    renderer = Renderer(H,W,C)
+    rendered = renderer.points(vbo2, ibo_)
+    rendered = renderer.lines(vbo2, ibo2)
+    rendered = renderer.polygons(vbo2, ibo3)
+    cv2.imwrite('/tmp/cv2draw.png', rendered)
 
-# 線の描画 VBO2とIBO2を利用
-lines = [np.stack([vbo[idxs[0]],vbo[idxs[1]]]) for vbo in [vbo2.astype(np.int32)] for idxs in ibo2]
-rendered = cv2.polylines( np.zeros((H,W,C),dtype=np.uint8), lines, isClosed=False,
-                color=(255,255,255),thickness=1,lineType=cv2.LINE_AA, shift=0)
 
-# 面の描画 VBO2とIBO3を利用
-polygons = [np.stack([vbo[idxs[0]],vbo[idxs[1]],vbo[idxs[2]]])
-                for vbo in [vbo2.astype(np.int32)] for idxs in ibo]
-rendered = cv2.fillPoly( np.zeros((H,W,C),dtype=np.uint8), polygons,
-                color=(255,255,255),lineType=cv2.LINE_AA, shift=0)
+if __name__=='__main__': main()
@@ -12,20 +12,129 @@ plt は import 自体しないこと。
 
 
 import io
+import os
+import time
+import queue
+import threading
+import tempfile
+import subprocess
+import collections
+import multiprocessing
 from pathlib import Path
 
-import tqdm
 import numpy as np
-from matplotlib.figure import Figure
 import cv2
 
+# パッケージ (pysnippets) としても，このディレクトリでスクリプトとしても使えるように
+try:
+    from . import cv2draw, profiling
+except ImportError:
+    import cv2draw, profiling
+
+# matplotlib と tqdm は使うときに import する (write_video だけ使うときに読み込まない)
+
+# 非同期の動画書き出し : write() はフレームをキューに入れるだけで，encode は別スレッドで行う
+#   with VideoWriter(path, fps, backend='ffmpeg') as writer:
+#       for frame in frames: writer.write(frame)
+#   print(writer.stats)
+# - backend='cv2'    : cv2.VideoWriter (mp4v)
+# - backend='ffmpeg' : ffmpeg の stdin に rawvideo を流す (libx264 などのマルチスレッド codec が使える)
+# - depth            : キューの長さ．埋まっていると write() が待つ (stalls に数える)
+# キューにはフレームの参照が入るので，write() した後にそのフレームを書き換えないこと
+class VideoWriter:
+    def __init__(self, path, fps=30.0, backend='cv2', depth=8, codec=None):
+        assert backend in ('cv2','ffmpeg'), 'backend error'
+        self.path = Path(path)
+        self.fps = fps
+        self.backend = backend
+        self.codec = codec
+        self.queue = queue.Queue(maxsize=depth)
+        self.thread = None
+        self.error = None
+        self.stats = {'frames':0, 'encode_sec':0.0, 'stalls':0, 'stall_sec':0.0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _open(self, H,W):
+        # VideoWriter 設定は (W,H) であることに注意 (合わないと再生できない動画ができる)
+        if self.backend == 'cv2':
+            fourcc = cv2.VideoWriter_fourcc(*(self.codec if self.codec else 'mp4v'))
+            writer = cv2.VideoWriter( str(self.path), fourcc, self.fps, (W,H) )
+            return writer.write, writer.release
+        command = [ 'ffmpeg', '-y', '-loglevel', 'error',
+                    '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '%dx%d'%(W,H), '-r', str(self.fps),
+                    '-i', '-', '-c:v', self.codec if self.codec else 'libx264',
+                    '-pix_fmt', 'yuv420p', str(self.path) ]
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE)
+        def close():
+            proc.stdin.close()
+            assert proc.wait() == 0, 'ffmpeg failed'
+        return (lambda frame: proc.stdin.write(np.ascontiguousarray(frame).data)), close
+
+    def _run(self, H,W):
+        close = None
+        try:
+            write, close = self._open(H,W)
+            while True:
+                frame = self.queue.get()
+                if frame is None:
+                    break
+                start = time.perf_counter()
+                with profiling.stage('encode'):
+                    write(frame)
+                self.stats['encode_sec'] += time.perf_counter()-start
+                self.stats['frames'] += 1
+        except Exception as e:
+            self.error = e
+            # 書き込み側が止まらないようにキューを空にし続ける
+            while self.queue.get() is not None:
+                pass
+        finally:
+            if close is not None:
+                start = time.perf_counter()
+                try:
+                    close()
+                except Exception as e:
+                    self.error = self.error if self.error else e
+                self.stats['encode_sec'] += time.perf_counter()-start
+
+    def write(self, frame):
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            H,W = frame.shape[:2]
+            self.thread = threading.Thread(target=self._run, args=(H,W), daemon=True)
+            self.thread.start()
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            start = time.perf_counter()
+            self.queue.put(frame)
+            self.stats['stalls'] += 1
+            self.stats['stall_sec'] += time.perf_counter()-start
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        e = self.stats['encode_sec']
+        self.stats['fps'] = self.stats['frames']/e if e > 0 else 0.0
+        if self.error is not None:
+            raise self.error
+
 
 # 動画書き出し関数
-def write_video( imgs, path, fps=30.0 ):
-    T,H,W,C = imgs.shape
-    # VideoWriter 設定は (W,H) であることに注意 (合わないと再生できない動画ができる)
-    [ [ writer.write(frame) for frame in tqdm.tqdm(imgs) ]
-        for writer in [ cv2.VideoWriter( str(path),cv2.VideoWriter_fourcc(*'mp4v'),fps,(W,H) ) ] ]
+def write_video( imgs, path, fps=30.0, backend='cv2' ):
+    with VideoWriter( path, fps, backend=backend ) as writer:
+        import tqdm
+        for frame in tqdm.tqdm(imgs):
+            writer.write(frame)
+    return writer.stats
 
 
 # generator-based : 大量の画像をメモリに保持するのが難しいときは毎フレームレンダリングする
@@ -35,10 +144,12 @@ class VideoFrames:
         self.shape = (len(self),H,W,3)
     def __len__(self):
         return len(self.data)
+    @profiling.timed('render')
     def __getitem__(self,idx):
         T,H,W,C = self.shape
         dpi = 180
         figsize_inch = np.array([W,H]) / dpi
+        from matplotlib.figure import Figure
         fig = Figure(figsize=figsize_inch, dpi=dpi)
         sbplt = fig.add_subplot(1,1,1)
 
@@ -48,12 +159,127 @@ class VideoFrames:
         sbplt.plot(x,y)
         sbplt.set_ylim(-1.0, 1.0)
 
-        with io.BytesIO() as buf:
+        with profiling.stage('png'), io.BytesIO() as buf:
             fig.savefig( buf, format="png", dpi=dpi )
             frame = cv2.imdecode( np.frombuffer( buf.getvalue(), dtype=np.uint8 ), 1)
         return frame
 
 
+# 高速版 : Figure/Axes を使い回して線のデータだけ更新する
+#   - 軸などの静的な部分は最初に 1 回だけ描いて背景として保存しておき，毎フレーム貼り直す (blit)
+#   - PNG に encode → decode せずに Agg canvas の buffer_rgba() をそのまま numpy で読む
+# Figure はプロセスごとに最初の __getitem__ で作る (pickle するときは持ち越さない)
+class VideoFramesAgg:
+    def __init__(self, data, H,W):
+        self.data = data
+        self.shape = (len(self),H,W,3)
+        self.canvas = None
+    def __len__(self):
+        return len(self.data)
+    # setup() で作るもの (matplotlib のオブジェクト) は pickle できないので送らない
+    def __getstate__(self):
+        state = {**self.__dict__, 'canvas':None}
+        for k in ('sbplt','line','background','x'):
+            state.pop(k, None)
+        return state
+    def setup(self):
+        T,H,W,C = self.shape
+        dpi = 180
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=(W/dpi,H/dpi), dpi=dpi)
+        self.canvas = FigureCanvasAgg(fig)
+        self.sbplt = fig.add_subplot(1,1,1)
+
+        sample = 100
+        self.x = np.linspace(0,10, sample)
+        self.line, = self.sbplt.plot(self.x,np.zeros_like(self.x),animated=True)
+        self.sbplt.set_ylim(-1.0, 1.0)
+
+        self.canvas.draw()
+        # 線が軸の枠 (ylim の端) にかかるとその 1px は sbplt.bbox の外に描かれて残るので，図全体を退避する
+        self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+    @profiling.timed('render')
+    def __getitem__(self,idx):
+        if self.canvas is None:
+            self.setup()
+        self.canvas.restore_region(self.background)
+        self.line.set_ydata(np.sin(self.x+self.data[idx]))
+        self.sbplt.draw_artist(self.line)
+        rgba = np.asarray(self.canvas.buffer_rgba())
+        return cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR)
+
+
+
+# 並列版 : VideoFrames などのフレーム列をプロセスプールでレンダリングする
+#   - 各ワーカーは最初に frames を 1 回だけ受け取り，Figure をワーカー内で使い回す
+#   - 投げるのはフレーム番号だけで，結果は投げた順に deque から取り出す (並べ替えバッファ)
+#   - 同時にレンダリング中のフレームは inflight 枚まで (メモリが増えすぎない)
+# write_video( ParallelFrames(VideoFramesAgg(data,H,W)), path ) のようにそのまま渡せる
+_worker_frames = None
+
+def _init_worker(frames):
+    global _worker_frames
+    _worker_frames = frames
+
+def _render_worker(idx):
+    return _worker_frames[idx]
+
+class ParallelFrames:
+    def __init__(self, frames, workers=None, inflight=None):
+        self.frames = frames
+        self.shape = frames.shape
+        self.workers = workers if workers else os.cpu_count()
+        self.inflight = inflight if inflight else 2*self.workers
+    def __len__(self):
+        return len(self.frames)
+    def __getitem__(self,idx):
+        return self.frames[idx]
+    def __iter__(self):
+        with multiprocessing.Pool(self.workers, _init_worker, (self.frames,)) as pool:
+            pending = collections.deque()
+            for idx in range(len(self)):
+                pending.append( pool.apply_async(_render_worker, (idx,)) )
+                if len(pending) >= self.inflight:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+
+
+# 区間並列の書き出し : フレーム列を segments 個に分け，各区間を別プロセスで一時ファイルに encode し，
+# 最後に ffmpeg の concat demuxer で再 encode せずに (-c copy) 1 つのファイルにつなげる．
+# フレーム数と fps はそのまま．ffmpeg が必要．
+# imgs は (T,H,W,C) の ndarray でも VideoFrames などでもよい (ワーカーには 1 回だけ渡す)
+def _encode_segment(args):
+    start, stop, path, fps, backend = args
+    with VideoWriter( path, fps, backend=backend ) as writer:
+        for idx in range(start, stop):
+            writer.write(_worker_frames[idx])
+    return writer.stats
+
+def write_video_parallel( imgs, path, fps=30.0, segments=None, backend='ffmpeg' ):
+    path = Path(path)
+    T = len(imgs)
+    # write_video と同じく，フレームがなければファイルは作らない
+    if T == 0:
+        return []
+    segments = min(segments if segments else os.cpu_count(), T)
+    bounds = np.linspace(0, T, segments+1).astype(int)
+    with tempfile.TemporaryDirectory(dir=path.parent) as tmpdir:
+        tmpdir = Path(tmpdir)
+        tasks = [ (start, stop, tmpdir/('%05d%s'%(i,path.suffix)), fps, backend)
+                    for i,(start,stop) in enumerate(zip(bounds[:-1],bounds[1:])) ]
+        with multiprocessing.Pool(segments, _init_worker, (imgs,)) as pool:
+            stats = pool.map(_encode_segment, tasks)
+        # concat のリストの相対パスはリストファイルのディレクトリから解決されるので，名前だけを書く
+        # (' は '\'' にエスケープ)
+        listfile = tmpdir/'list.txt'
+        listfile.write_text(''.join("file '%s'\n"%task[2].name.replace("'","'\\''") for task in tasks))
+        subprocess.run( [ 'ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                            '-i', str(listfile), '-c', 'copy', str(path) ], check=True )
+    return stats
+
 
 def main():
     T,H,W,C = 300,480,640,3
@@ -63,15 +289,11 @@ def main():
     rad_per_frame = rad_per_sec/fps
 
     # 1: numpy で作成した画像シーケンスを書き出す。
-    frames = np.empty((T,H,W,C),dtype=np.uint8)
-    grid = np.mgrid[:H,:W].transpose(1,2,0)
+    #    頂点の軌跡 (T,1,2_xy) を cv2draw でまとめて描く
     r = min(H,W)*0.4
-    for t in range(T):
-        pos = np.array([H/2,W/2])+np.array([r*np.sin(t*rad_per_frame),
-                                            r*np.cos(t*rad_per_frame)])
-        dist = ((grid-pos[None,None,:])**2).sum(axis=2)**0.5
-        d = np.where(dist>=5,0,255)[:,:,None].astype(np.uint8)
-        frames[t] = np.c_[d,d,d]
+    t = np.arange(T)*rad_per_frame
+    vbos = np.stack([W/2+r*np.cos(t), H/2+r*np.sin(t)],axis=1)[:,None,:]
+    frames = cv2draw.render_video( vbos, H,W,C, ibo_=np.array([0]), radius=4 )
     write_video( frames, Path('/tmp/sample1.mp4'), fps=fps)
 
     # 2: matplotlib で作成した画像シーケンスを書き出す。
@@ -1,9 +1,22 @@
 from pathlib import Path
+from multiprocessing import shared_memory
+import multiprocessing
+import threading
+import weakref
+import hashlib
+import queue
+import os
 
 import numpy as np
 import cv2
 
-print(cv2.__version__) # 3.4.2
+# パッケージ (pysnippets) としても，このディレクトリでスクリプトとしても使えるように
+try:
+    from . import profiling
+except ImportError:
+    import profiling
+
+# cv2.__version__ 3.4.2 で確認
 
 ### simple use case ############################################################
 
@@ -65,6 +78,476 @@ def read_video3(path, slice_obj):
     return ( True, np.stack(frames) )
 
 
+### decode-time transform ######################################################
+
+# 読んだフレームをすぐに切り出し・縮小・色変換・型変換して，最終的な形の配列に直接書く．
+# 元の解像度のフレームを溜め込まないので，メモリと帯域は出力の大きさで決まる．
+#   transform = FrameTransform(roi=(x,y,w,h), size=(W,H), color=cv2.COLOR_BGR2GRAY,
+#                              dtype=np.float32, scale=1/255)
+#   reader = VideoReader(path, transform)      # reader[::10] は (k,H,W) の float32
+# 順番は roi → size → color → dtype (scale を掛ける)．
+# 途中の配列は使い回し，最後の処理は出力先 (out) に直接書き込む．
+# size を指定すると VideoReader はバックエンドでの縮小 (CAP_PROP_FRAME_WIDTH/HEIGHT) も試す
+# (カメラなどでは効くが，動画ファイルではたいてい効かないので cv2.resize する)
+
+class FrameTransform:
+    def __init__(self, roi=None, size=None, color=None, dtype=np.uint8, scale=None,
+                    interpolation=cv2.INTER_AREA):
+        self.roi = roi
+        self.size = tuple(size) if size is not None else None
+        self.color = color
+        self.dtype = np.dtype(dtype)
+        self.scale = scale
+        self.interpolation = interpolation
+        self._buffers = {}
+
+    # FrameCache のキーに使う
+    def __repr__(self):
+        return 'FrameTransform(roi=%r, size=%r, color=%r, dtype=%r, scale=%r, interpolation=%r)'%(
+                    self.roi, self.size, self.color, self.dtype.str, self.scale, self.interpolation)
+
+    def __getstate__(self):
+        return {**self.__dict__, '_buffers':{}}
+
+    def __call__(self, frame, out=None):
+        x = frame
+        if self.roi is not None:
+            x0,y0,w,h = self.roi
+            x = x[y0:y0+h, x0:x0+w]
+        ops = []
+        if self.size is not None and x.shape[1::-1] != self.size:
+            ops += [lambda src,dst: cv2.resize(src, self.size, dst=dst, interpolation=self.interpolation)]
+        if self.color is not None:
+            ops += [lambda src,dst: cv2.cvtColor(src, self.color, dst=dst)]
+        # 型変換がなければ最後の処理は out に直接書く
+        direct = out is not None and out.dtype == x.dtype and self.scale is None
+        for i,op in enumerate(ops):
+            if direct and i == len(ops)-1:
+                x = op(x, out)
+            else:
+                x = op(x, self._buffers.get(i))
+                self._buffers[i] = x
+        if out is None:
+            out = np.empty(x.shape, dtype=self.dtype)
+        if x is not out:
+            if self.scale is None:
+                np.copyto(out, x, casting='unsafe')
+            else:
+                np.multiply(x, self.scale, out=out, casting='unsafe')
+        return out
+
+
+### streaming / lazily-indexed reader ##########################################
+
+# 全フレームを list に溜めて np.stack すると動画2本分のメモリが必要になる．
+# VideoReader は 1 フレームずつ読むので，長い動画でもメモリは一定．
+#   for frame in reader         : 1 フレームずつ
+#   reader[i], reader[a:b:c]    : ランダムアクセス (slice は (k,H,W,C) を返す)
+#   reader.chunks(k)            : (k,H,W,C) ごとに返す (最後だけ短いことがある)
+# read_video2 と同じく，途中で読めなくなったら読めたところまでを返し
+# reader.ok が False になる．1 フレームも読めなかった場合は None を返す．
+# transform (FrameTransform) を渡すと，各フレームを変換してから返す．
+
+class VideoReader:
+    seek_threshold = 64
+
+    def __init__(self, path, transform=None):
+        self.path = Path(path)
+        self.cap = cv2.VideoCapture(str(path))
+        assert self.cap.isOpened()
+        self.transform = transform
+        self._raw = None
+        # バックエンドで縮小できるなら任せる (できなければ FrameTransform が cv2.resize する)
+        if transform is not None and transform.size is not None and transform.roi is None:
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, transform.size[0])
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, transform.size[1])
+        self.num_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = float(self.cap.get(cv2.CAP_PROP_FPS))
+        self.pos = 0    # 次に cap.read() で読まれるフレーム番号
+        self.index = -1 # 最後に読んだフレーム番号
+        self.indice = []
+        self.ok = True
+
+    def __len__(self):
+        return self.num_frames
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def release(self):
+        self.cap.release()
+
+    # idx 番目のフレームを読む．
+    #   - 連続して読むときは seek しない
+    #   - 少し先 (seek_threshold 未満) なら grab() で retrieve せずに読み飛ばす
+    #   - それより先か後ろなら CAP_PROP_POS_FRAMES で seek (キーフレームから decode し直し)
+    # seek したときは実際に読めたフレーム番号を self.index に入れる
+    # out を渡すとそこに直接書き込む (transform があれば変換した結果を書く)
+    def read(self, idx, out=None):
+        seeked = False
+        with profiling.stage('decode'):
+            if 0 <= self.pos < idx < self.pos+self.seek_threshold:
+                for _ in range(idx-self.pos):
+                    if not self.cap.grab():
+                        self.pos = -1
+                        return False, None
+            elif idx != self.pos:
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+                seeked = True
+            # transform があるときは decode 先のバッファを使い回す
+            ret,frame = self.cap.read(out if self.transform is None else self._raw)
+        if ret and seeked:
+            idx = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))-1
+        self.pos = idx+1 if ret else -1
+        self.index = idx
+        if not ret:
+            return False, None
+        if self.transform is not None:
+            self._raw = frame
+            with profiling.stage('transform'):
+                frame = self.transform(frame, out)
+        elif out is not None and frame is not out:
+            out[...] = frame
+            frame = out
+        return ret, frame
+
+    # indice のフレームを最終的な形の配列に直接書き込む (list + np.stack しない)
+    # 実際に取得できたフレーム番号は self.indice に入る
+    def _collect(self, indice):
+        frames = None
+        self.indice = []
+        for n,idx in enumerate(indice):
+            ret,frame = self.read(idx, None if frames is None else frames[n])
+            if not ret:
+                self.ok = False
+                return None if frames is None else frames[:n]
+            if frames is None:
+                frames = np.empty((len(indice),)+frame.shape, dtype=frame.dtype)
+                frames[n] = frame
+            self.indice += [self.index]
+        return frames
+
+    def __iter__(self):
+        for idx in range(self.num_frames):
+            ret,frame = self.read(idx)
+            if not ret:
+                self.ok = False
+                return
+            yield frame
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self._collect(range(*idx.indices(self.num_frames)))
+        if idx < 0:
+            idx += self.num_frames
+        if not 0 <= idx < self.num_frames:
+            raise IndexError('frame index out of range')
+        ret,frame = self.read(idx)
+        if not ret:
+            self.ok = False
+            raise IndexError('failed to read frame %d'%idx)
+        return frame
+
+    def chunks(self, k):
+        for start in range(0, self.num_frames, k):
+            frames = self._collect(range(start, min(start+k, self.num_frames)))
+            if frames is not None:
+                yield frames
+            if not self.ok:
+                return
+
+
+### seek-based sparse sampling #################################################
+
+# read_video3 は全フレームを decode してから間引くので，step=30 なら 30 倍遅い．
+# VideoReader.read は step が小さければ grab() で読み飛ばし，
+# 大きければ seek するので，返すフレーム数に比例した時間で済む．
+# 戻り値は ( status, frames, indice ) で，indice は実際に取得できたフレーム番号．
+
+def read_video4(path, slice_obj, transform=None):
+    with VideoReader(path, transform) as reader:
+        frames = reader[slice_obj]
+        return ( reader.ok, frames, reader.indice )
+
+
+### on-disk decoded-frame cache ################################################
+
+# 同じ動画を何度も decode するときに，decode 済みのフレームを .npy に書いておき，
+# 2 回目以降は np.memmap (読み込み専用，コピーなし) で返す．
+#   cache = FrameCache(Path('/tmp/frame_cache'), max_bytes=50*2**30)
+#   status, frames = cache.read(path, slice(None,None,30))
+# - キー : 絶対パス，ファイルサイズ，mtime，slice，transform
+# - 容量 : max_bytes を超えたら最後に使われたのが古いものから消す (LRU，mtime で管理)
+# - 複数プロセス : 各プロセスは一時ファイルに書いてから os.replace するので，
+#                 同時に同じエントリを作っても壊れない (先に終わった方が上書きされるだけ)
+# 途中で読めなくなった動画はキャッシュしない (ndarray で返す)
+
+class FrameCache:
+    def __init__(self, root, max_bytes=None):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True,exist_ok=True)
+
+    def key(self, path, slice_obj, transform=None):
+        path = Path(path).resolve()
+        stat = path.stat()
+        params = ( str(path), stat.st_size, stat.st_mtime_ns,
+                    slice_obj.start, slice_obj.stop, slice_obj.step, repr(transform) )
+        return hashlib.sha1(repr(params).encode()).hexdigest()
+
+    def read(self, path, slice_obj=slice(None), transform=None):
+        entry = self.root/(self.key(path,slice_obj,transform)+'.npy')
+        try:
+            frames = np.load(entry, mmap_mode='r')
+            os.utime(entry)
+            return ( True, frames )
+        except FileNotFoundError:
+            pass
+
+        tmp = entry.with_name('%s.%d.tmp.npy'%(entry.stem,os.getpid()))
+        try:
+            with VideoReader(path, transform) as reader:
+                indice = range(*slice_obj.indices(len(reader)))
+                frames = None
+                for n,idx in enumerate(indice):
+                    ret,frame = reader.read(idx, None if frames is None else frames[n])
+                    if not ret:
+                        return ( False, None if frames is None else np.array(frames[:n]) )
+                    if frames is None:
+                        frames = np.lib.format.open_memmap(tmp, mode='w+',
+                                    dtype=frame.dtype, shape=(len(indice),)+frame.shape)
+                        frames[n] = frame
+            if frames is None:
+                return ( True, None )
+            frames.flush()
+            del frames
+            os.replace(tmp, entry)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+        frames = np.load(entry, mmap_mode='r')
+        self.evict()
+        return ( True, frames )
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        entries = []
+        for p in self.root.glob('*.npy'):
+            if p.name.endswith('.tmp.npy'):
+                continue
+            try:
+                stat = p.stat()
+            except FileNotFoundError:
+                continue
+            entries += [(stat.st_mtime, stat.st_size, p)]
+        total = sum(size for _,size,_ in entries)
+        for _,size,p in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for p in self.root.glob('*.npy'):
+            p.unlink()
+
+
+### multi-process parallel decoding ############################################
+
+# フレーム範囲を workers 個に分け，各プロセスが自分で VideoCapture を開いて
+# 担当区間の先頭に seek し，共有メモリ上の (T,H,W,C) 配列に直接 decode する．
+# 結果は read_video と同じ．途中で読めなかった場合は最初に読めなかったフレームの
+# 手前までを返す．transform を渡すと各ワーカーが変換してから書き込む．
+# 返す配列は共有メモリそのもの (コピーしないのでピークは decode 結果 1 つ分)．
+# 共有メモリは返した配列 (とそのビュー) が全部消えたときに close + unlink される．
+
+# 共有メモリの持ち主．np.asarray(owner) の base になるので，配列が生きている間は消えない
+class _SharedFrames:
+    def __init__(self, shm, shape, dtype):
+        self.shm = shm
+        address = np.frombuffer(shm.buf, dtype=np.uint8).ctypes.data
+        self.__array_interface__ = { 'version': 3, 'shape': shape, 'typestr': dtype.str,
+                                        'data': (address, False) }
+        weakref.finalize(self, _SharedFrames.release, shm)
+
+    @staticmethod
+    def release(shm):
+        shm.close()
+        shm.unlink()
+
+
+def _decode_segment(args):
+    path, name, shape, dtype, transform, start, stop = args
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        frames = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        with VideoReader(path, transform) as reader:
+            ret,frame = reader.read(start, frames[start])
+            # seek が正確でないコーデックでは別のフレームに着くので，そのときは先頭に戻って grab で進める
+            if ret and reader.index != start:
+                reader.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                reader.pos = 0
+                reader.seek_threshold = start+1
+                ret,frame = reader.read(start, frames[start])
+            if not ret:
+                return start
+            for idx in range(start+1, stop):
+                ret,frame = reader.read(idx, frames[idx])
+                if not ret:
+                    return idx
+        del frames
+        return stop
+    finally:
+        shm.close()
+
+
+def read_video_parallel(path, workers=None, transform=None):
+    with VideoReader(path, transform) as reader:
+        num_frames = len(reader)
+        ret,frame = reader.read(0)
+    if not ret:
+        return None
+    shape = (num_frames,)+frame.shape
+    dtype = frame.dtype
+    # CAP_PROP_FRAME_COUNT が取れない (0) ときは分けられないので，1 プロセスで読めるところまで読む
+    if num_frames == 0:
+        frames = []
+        with VideoReader(path, transform) as reader:
+            while True:
+                ret,frame = reader.read(len(frames))
+                if not ret:
+                    return np.stack(frames)
+                frames += [frame]
+
+    workers = workers if workers else os.cpu_count()
+    bounds = np.linspace(0, num_frames, min(workers,num_frames)+1).astype(int)
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape))*dtype.itemsize)
+    try:
+        segments = [ (str(path), shm.name, shape, dtype, transform, start, stop)
+                        for start,stop in zip(bounds[:-1],bounds[1:]) ]
+        with multiprocessing.Pool(len(segments)) as pool:
+            reached = pool.map(_decode_segment, segments)
+    except BaseException:
+        _SharedFrames.release(shm)
+        raise
+    num_read = num_frames
+    for segment,last in zip(segments,reached):
+        if last != segment[-1]:
+            num_read = last
+            break
+    return np.asarray(_SharedFrames(shm, shape, dtype))[:num_read]
+
+
+### background prefetching #####################################################
+
+# decode を別スレッドで先読みして，消費側の処理 (推論など) と重ねる．
+# フレームは depth+1 枚の使い回しバッファに cap.read(buf) で直接書かれるので，
+# 毎フレームの確保は起きない．
+#   with PrefetchReader(path, depth=4) as reader:
+#       for frame in reader: ...
+# 返した frame は次のフレームを要求した時点で上書きされるので，
+# 保持したいときは frame.copy() すること．
+# decode 中の例外は消費側で再送出される．途中で読めなくなったら reader.ok が False．
+# ループを break するか close() すると decode スレッドも止まる．
+# transform を渡すと，decode 用のバッファ 1 枚から変換してリングバッファに書く．
+
+class PrefetchReader:
+    def __init__(self, path, depth=4, transform=None):
+        self.path = Path(path)
+        self.depth = depth
+        self.transform = transform
+        self.buffers = []
+        self.ok = True
+        self._stop = threading.Event()
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # 空きバッファを待つ．止められたら None
+    def _take_free(self):
+        while not self._stop.is_set():
+            try:
+                return self._free.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _run(self):
+        try:
+            cap = cv2.VideoCapture(str(self.path))
+            assert cap.isOpened()
+            num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            raw = None
+            for idx in range(num_frames):
+                if idx == 0:
+                    slot = 0
+                else:
+                    slot = self._take_free()
+                    if slot is None:
+                        break
+                out = self.buffers[slot] if self.buffers else None
+                with profiling.stage('decode'):
+                    ret,frame = cap.read(out if self.transform is None else raw)
+                if not ret:
+                    self._filled.put(('end',False))
+                    return
+                if self.transform is not None:
+                    raw = frame
+                    with profiling.stage('transform'):
+                        frame = self.transform(raw, out)
+                if not self.buffers:
+                    self.buffers = [frame]+[np.empty_like(frame) for _ in range(self.depth)]
+                    [self._free.put(i) for i in range(1,self.depth+1)]
+                self._filled.put(('frame',slot))
+            self._filled.put(('end',True))
+        except Exception as e:
+            self._filled.put(('error',e))
+        finally:
+            cap.release()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __iter__(self):
+        self.start()
+        held = None
+        try:
+            while True:
+                if held is not None:
+                    self._free.put(held)
+                    held = None
+                kind,value = self._filled.get()
+                if kind == 'end':
+                    self.ok = value
+                    return
+                if kind == 'error':
+                    raise value
+                held = value
+                yield self.buffers[held]
+        finally:
+            self.close()
+
+
 def main():
     status, seq = read_video3(Path('/home/horiuchi/Documents/sample_movie/output.mp4'),slice(None,None,30))
     print(status)
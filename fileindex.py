@@ -0,0 +1,133 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+from pathlib import Path
+
+'''
+-----------------------------------------------------
+# 大きくてあまり変わらないディレクトリツリーを何度も検索するときのための索引
+files.find* を毎回走査する代わりに，パス・種類・サイズ・mtime を SQLite に保存しておき，
+検索は SQLite に問い合わせるだけにする．
+
+    index = FileIndex(Path('/data/dataset'))
+    index.update()                              # 初回は全走査，2 回目以降は差分だけ
+    paths = index.find(r'^.*\\/[^/]+\\.png$', kind='f')
+    paths = index.glob('*/train/*.png')
+    print(index.staleness())
+-----------------------------------------------------
+# 差分更新について
+ディレクトリの mtime はその直下でファイルの追加・削除・名前変更があったときだけ変わる．
+update() は mtime が変わったディレクトリだけ scandir し直し，それ以外は索引にある
+サブディレクトリを辿るだけにする (stat はディレクトリごとに 1 回)．
+既存ファイルを上書きしただけではディレクトリの mtime は変わらないので，
+ファイルのサイズ・mtime まで正確にしたいときは update(full=True) で作り直す．
+-----------------------------------------------------
+'''
+
+class FileIndex:
+    def __init__(self, root, db=None):
+        self.root = Path(root).resolve()
+        if db is None:
+            name = hashlib.sha1(str(self.root).encode()).hexdigest()+'.sqlite'
+            db = Path.home()/'.cache'/'pysnippets'/'fileindex'/name
+        self.db = Path(db)
+        self.db.parent.mkdir(parents=True,exist_ok=True)
+        self.conn = sqlite3.connect(str(self.db))
+        self.conn.create_function('REGEXP', 2, self._regexp, deterministic=True)
+        self._patterns = {}
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                path TEXT PRIMARY KEY, parent TEXT, is_dir INTEGER, size INTEGER, mtime_ns INTEGER );
+            CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+            CREATE TABLE IF NOT EXISTS dirs ( path TEXT PRIMARY KEY, mtime_ns INTEGER );
+            CREATE TABLE IF NOT EXISTS meta ( key TEXT PRIMARY KEY, value );
+        ''')
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _regexp(self, pattern, item):
+        if pattern not in self._patterns:
+            self._patterns[pattern] = re.compile(pattern)
+        return self._patterns[pattern].search(item) is not None
+
+    # ディレクトリ d 以下 (d 自身を含む) を索引から消す
+    def _forget(self, d):
+        like = d.replace('!','!!').replace('%','!%').replace('_','!_')+os.sep+'%'
+        for table in ('entries','dirs'):
+            self.conn.execute("DELETE FROM "+table+" WHERE path = ? OR path LIKE ? ESCAPE '!'", (d,like))
+
+    # 戻り値は scandir し直したディレクトリの数
+    def update(self, full=False):
+        with self.conn:
+            if full:
+                self.conn.execute('DELETE FROM entries')
+                self.conn.execute('DELETE FROM dirs')
+            known = dict(self.conn.execute('SELECT path, mtime_ns FROM dirs'))
+            rescanned = 0
+            stack = [str(self.root)]
+            while stack:
+                d = stack.pop()
+                try:
+                    mtime_ns = os.stat(d).st_mtime_ns
+                except FileNotFoundError:
+                    self._forget(d)
+                    continue
+                if known.get(d) == mtime_ns:
+                    stack += [p for p, in self.conn.execute(
+                                'SELECT path FROM entries WHERE parent = ? AND is_dir = 1', (d,))]
+                    continue
+                rescanned += 1
+                old_dirs = {p for p, in self.conn.execute(
+                                'SELECT path FROM entries WHERE parent = ? AND is_dir = 1', (d,))}
+                rows = []
+                with os.scandir(d) as it:
+                    for entry in it:
+                        try:
+                            stat = entry.stat(follow_symlinks=False)
+                        except FileNotFoundError:
+                            continue
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        rows += [(entry.path, d, int(is_dir), stat.st_size, stat.st_mtime_ns)]
+                new_dirs = {row[0] for row in rows if row[2]}
+                for gone in old_dirs-new_dirs:
+                    self._forget(gone)
+                self.conn.execute('DELETE FROM entries WHERE parent = ?', (d,))
+                self.conn.executemany('INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?)', rows)
+                self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?,?)', (d,mtime_ns))
+                stack += sorted(new_dirs)
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('updated', ?)", (time.time(),))
+        return rescanned
+
+    # age : 最後の update() からの秒数 (一度も update していなければ None)
+    # changed_dirs : 索引を作ってから mtime が変わった (消えたものも含む) ディレクトリの数
+    def staleness(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'updated'").fetchone()
+        changed = 0
+        for d,mtime_ns in self.conn.execute('SELECT path, mtime_ns FROM dirs'):
+            try:
+                changed += os.stat(d).st_mtime_ns != mtime_ns
+            except FileNotFoundError:
+                changed += 1
+        return {'age': None if row is None else time.time()-row[0], 'changed_dirs': changed}
+
+    def _query(self, where, arg, kind):
+        assert kind in ('f','d','a'), 'find kind error'
+        cond = {'f':' AND is_dir = 0', 'd':' AND is_dir = 1', 'a':''}[kind]
+        return [Path(p) for p, in self.conn.execute('SELECT path FROM entries WHERE '+where+cond, (arg,))]
+
+    # files.find と同じく，パスの文字列に re.search して合うもの
+    def find(self, pattern, kind='a'):
+        return self._query('path REGEXP ?', pattern, kind)
+
+    # root からの相対パスに対する glob (SQLite の GLOB なので * は / にもマッチする)
+    def glob(self, pattern, kind='a'):
+        return self._query('path GLOB ?', str(self.root/pattern), kind)
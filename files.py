@@ -1,6 +1,15 @@
+import os
 import re
+import atexit
 import shutil
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# パッケージ (pysnippets) としても，このディレクトリでスクリプトとしても使えるように
+try:
+    from . import profiling
+except ImportError:
+    import profiling
 
 '''
 -----------------------------------------------------
@@ -11,6 +20,7 @@ from pathlib import Path
 # 関数名の後ろについている文字の意味
 H : 既に存在する場合上書き
 S : 既に存在する場合無視
+U : 既に存在する場合，変更があったものだけ上書き
 
 F : ファイル
 D : ディレクトリ
@@ -25,13 +35,15 @@ C : 指定したディレクトリのみ
 -----------------------------------------------------
 # 関数の一覧
 ## ディレクトリを作成する
-- mkdirH : path
+- mkdirH : path, background=False
 - mkdirS : path
 
 ## ディレクトリ・ファイルに関わらず削除・コピー・移動をする
-- rm  : path
+- rm  : path, background=False
+- rmWait :
 - cpH : src, dst
 - cpS : src, dst
+- cpU : src, dst, checksum=False, delete=False, workers=8
 - mvH : src, dst
 - mvS : src, dst
 
@@ -42,16 +54,41 @@ C : 指定したディレクトリのみ
 - findDC : path, pattern
 - findAR : path, pattern
 - findAC : path, pattern
+
+## 上の find** をまとめたもの (list ではなく generator で，見つかった順に返す)
+- find : path, pattern, kind='a', recursive=True, include=None, exclude=None
+
+## find を複数スレッドで走査するもの (NFS/SMB などの遅いファイルシステム向け)
+- findP : path, pattern, kind='a', include=None, exclude=None, workers=16, sort=False
 ----------------------------------------------------------
 # ルール
 それぞれの関数の中では，このファイルで定義されている自分以外の関数を使わない．
 ----------------------------------------------------------
 '''
 
+# background=True のときの削除
+#   消すディレクトリを隣の隠しディレクトリ (.名前.rm-xxxx) に rename してすぐに返り，
+#   中身はスレッドプールで直下のサブツリーごとに並列に消す．
+#   rmWait() で残っている削除が終わるのを待つ (プログラム終了時にも呼ばれる)
+_deleter = ThreadPoolExecutor(8)
+_tombstones = []
+
 # ディレクトリの作成(既に存在する場合上書き)
-def mkdirH(path):
+def mkdirH(path,background=False):
     # 既に存在していたら消す
-    shutil.rmtree(path,ignore_errors=True)
+    # シンボリックリンクはリンクだけ消す (rename して中を消すとリンク先を消してしまう)
+    if background and path.is_symlink():
+        path.unlink()
+    elif background and path.is_dir():
+        tomb = path.with_name('.%s.rm-%s'%(path.name,os.urandom(16).hex()))
+        path.rename(tomb)
+        def split():
+            with os.scandir(tomb) as it:
+                return [_deleter.submit(shutil.rmtree if e.is_dir(follow_symlinks=False) else os.unlink, e.path)
+                            for e in it]
+        _tombstones.append((tomb,_deleter.submit(split)))
+    else:
+        shutil.rmtree(path,ignore_errors=True)
     path.mkdir(parents=True)
 
 # ディレクトリの作成(既に存在する場合無視)
@@ -66,14 +103,37 @@ def mkdirS(path):
 '''
 
 # ディレクトリやファイルを消す
-def rm(path):
+def rm(path,background=False):
     # 消す対象が存在するとき，ディレクトリかファイルか判断して消す
     if path.exists():
-        if path.is_dir():
+        # シンボリックリンクはリンクだけ消す (rename して中を消すとリンク先を消してしまう)
+        if path.is_symlink() and background:
+            path.unlink()
+        elif path.is_dir() and background:
+            tomb = path.with_name('.%s.rm-%s'%(path.name,os.urandom(16).hex()))
+            path.rename(tomb)
+            def split():
+                with os.scandir(tomb) as it:
+                    return [_deleter.submit(shutil.rmtree if e.is_dir(follow_symlinks=False) else os.unlink, e.path)
+                                for e in it]
+            _tombstones.append((tomb,_deleter.submit(split)))
+        elif path.is_dir():
             shutil.rmtree(path)
         else:
             path.unlink()
 
+# background=True で始めた削除が全部終わるまで待つ
+@atexit.register
+def rmWait():
+    while _tombstones:
+        tomb,split = _tombstones.pop(0)
+        try:
+            wait(split.result())
+        except RuntimeError:
+            # 終了処理中はスレッドプールに追加できないので，残りはここで消す
+            pass
+        shutil.rmtree(tomb,ignore_errors=True)
+
 # ファイル・ディレクトリのコピー
 #   src:ファイル名, dst:ファイル名
 def cpH(src,dst):
@@ -108,6 +168,106 @@ def cpS(src,dst):
         #ファイルをコピー
         shutil.copy(src,dst)
 
+# ファイル・ディレクトリの差分コピー
+#   src:ファイル名, dst:ファイル名
+# サイズか mtime が違うファイルだけコピーする (mtime もコピーするので 2 回目以降は差分だけになる)
+#   - checksum : mtime ではなく中身のハッシュで比べる (サイズは先に比べる)
+#   - delete   : src に無いものを dst から消す
+#   - workers  : 同時にコピーするファイルの数
+# 大きいファイルは os.copy_file_range でカーネル内でコピーする (使えなければ shutil.copyfile)
+# 戻り値はコピーしたファイルの list
+# コピーできないもの (壊れたリンク，dst 側で種類が違うものなど) があっても残りは続け，
+# 最後に shutil.Error ((src, dst, 理由) の list，copytree と同じ) を送出する．
+# delete=True なら dst 側で種類 (ファイルかディレクトリか) が違うものは消してから作り直す
+def cpU(src,dst,checksum=False,delete=False,workers=8):
+    def digest(path):
+        import hashlib
+        h = hashlib.sha256()
+        with open(path,'rb') as f:
+            for block in iter(lambda: f.read(1<<20), b''):
+                h.update(block)
+        return h.digest()
+
+    def changed(s,d):
+        try:
+            dstat = os.stat(d)
+        except FileNotFoundError:
+            return True
+        sstat = os.stat(s)
+        if sstat.st_size != dstat.st_size:
+            return True
+        if checksum:
+            return digest(s) != digest(d)
+        return sstat.st_mtime_ns != dstat.st_mtime_ns
+
+    def copy(s,d):
+        size = os.stat(s).st_size
+        if size >= (1<<20) and hasattr(os,'copy_file_range'):
+            with open(s,'rb') as fs, open(d,'wb') as fd:
+                try:
+                    while os.copy_file_range(fs.fileno(), fd.fileno(), 1<<30):
+                        pass
+                except OSError:
+                    # copy_file_range できないファイルシステム
+                    fs.seek(0)
+                    fd.seek(0)
+                    fd.truncate()
+                    shutil.copyfileobj(fs, fd, 1<<20)
+        else:
+            shutil.copyfile(s,d)
+        shutil.copystat(s,d)
+        return Path(d)
+
+    def sync(pair):
+        try:
+            if changed(*pair):
+                return copy(*pair)
+        except OSError as e:
+            errors.append((*pair, str(e)))
+        return None
+
+    # コピーするファイルを集め，必要なディレクトリを作る
+    errors = []
+    if not src.is_dir():
+        pairs = [(str(src),str(dst))]
+        if delete and dst.is_dir() and not dst.is_symlink():
+            shutil.rmtree(dst)
+        dst.parent.mkdir(parents=True,exist_ok=True)
+    else:
+        pairs = []
+        stack = [(str(src),str(dst))]
+        while stack:
+            s,d = stack.pop()
+            try:
+                os.makedirs(d,exist_ok=True)
+                # src のエントリ名 → ディレクトリかどうか
+                kinds = {}
+                with os.scandir(s) as it:
+                    for entry in it:
+                        kinds[entry.name] = entry.is_dir()
+                        if kinds[entry.name]:
+                            stack += [(entry.path, os.path.join(d,entry.name))]
+                        else:
+                            pairs += [(entry.path, os.path.join(d,entry.name))]
+                if delete:
+                    with os.scandir(d) as it:
+                        for entry in it:
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                            if kinds.get(entry.name) == is_dir:
+                                continue
+                            if is_dir:
+                                shutil.rmtree(entry.path)
+                            else:
+                                os.unlink(entry.path)
+            except OSError as e:
+                errors.append((s, d, str(e)))
+
+    with ThreadPoolExecutor(workers) as executor:
+        copied = [d for d in executor.map(sync, pairs) if d is not None]
+    if errors:
+        raise shutil.Error(errors)
+    return copied
+
 def mvH(src,dst):
     # 存在するなら消す(ファイルの場合，macなら消さなくても上書きになるがwinはわからない)
     if dst.exists():
@@ -163,8 +323,79 @@ def findAC(path,pattern):
 
 # 拡張子の有無でファイルかディレクトリか判断するのであれば
 # 正規表現の方で調整してこれですべて調べられる
-def find(path,pattern):
-    return [item for item in list(path.rglob('*')) if re.search(pattern,str(item))]
+#   list(find(path,pattern)) が以前の find(path,pattern) と同じ
+#
+# os.scandir ベースで 1 回だけ走査する generator
+#   - kind : 'f' ファイル, 'd' ディレクトリ, 'a' 両方
+#   - recursive : False なら path の直下だけ (find*C と同じ)
+#   - include, exclude : ディレクトリのパスに対する正規表現．
+#                        include に合わない，または exclude に合うディレクトリの下には潜らない
+#   - pattern はパスの文字列 (os.path.join(path, ...)) に対して re.search する (1 回だけ compile)
+#   - ファイルかディレクトリかは DirEntry のキャッシュを使うので，余計な stat をしない
+#   - シンボリックリンクのディレクトリの下には潜らない
+def find(path, pattern, kind='a', recursive=True, include=None, exclude=None):
+    assert kind in ('f','d','a'), 'find kind error'
+    search = re.compile(pattern).search
+    include = re.compile(include).search if include is not None else None
+    exclude = re.compile(exclude).search if exclude is not None else None
+    stack = [str(path)]
+    while stack:
+        with profiling.stage('readdir'), os.scandir(stack.pop()) as it:
+            entries = list(it)
+        for entry in entries:
+            is_dir = entry.is_dir()
+            # 'f' は findFR と同じく is_file() (壊れたリンク，FIFO，ソケットは入れない)
+            if kind == 'a' or (kind == 'd' and is_dir) or (kind == 'f' and entry.is_file()):
+                if search(entry.path):
+                    yield Path(entry.path)
+            if recursive and is_dir and not entry.is_symlink():
+                if include is not None and not include(entry.path):
+                    continue
+                if exclude is not None and exclude(entry.path):
+                    continue
+                stack += [entry.path]
+
+
+# find の並列版 (常に再帰的)
+# ネットワークファイルシステムでは readdir/stat の待ち時間が支配的なので，
+# ディレクトリごとの scandir を最大 workers 個のスレッドで同時に行う．
+# 見つかったサブディレクトリはスレッドプールの共有キューに積まれ，手の空いたスレッドが取る．
+# 絞り込みは find と同じ．返す順番は走査の進み方次第なので，
+# 決まった順番がほしいときは sort=True (全部揃ってからソートした list を返す)
+def findP(path, pattern, kind='a', include=None, exclude=None, workers=16, sort=False):
+    assert kind in ('f','d','a'), 'find kind error'
+    search = re.compile(pattern).search
+    include = re.compile(include).search if include is not None else None
+    exclude = re.compile(exclude).search if exclude is not None else None
+
+    @profiling.timed('readdir')
+    def scan(d):
+        matches, subdirs = [], []
+        with os.scandir(d) as it:
+            for entry in it:
+                is_dir = entry.is_dir()
+                if kind == 'a' or (kind == 'd' and is_dir) or (kind == 'f' and entry.is_file()):
+                    if search(entry.path):
+                        matches += [entry.path]
+                if is_dir and not entry.is_symlink():
+                    if include is not None and not include(entry.path):
+                        continue
+                    if exclude is not None and exclude(entry.path):
+                        continue
+                    subdirs += [entry.path]
+        return matches, subdirs
+
+    def walk():
+        with ThreadPoolExecutor(workers) as executor:
+            pending = {executor.submit(scan, str(path))}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    matches, subdirs = future.result()
+                    pending |= {executor.submit(scan, d) for d in subdirs}
+                    yield from (Path(m) for m in matches)
+
+    return sorted(walk()) if sort else walk()
 
 
 # ちゃんとモードを意識するなら
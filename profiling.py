@@ -0,0 +1,124 @@
+import os
+import json
+import math
+import time
+import threading
+import functools
+import contextlib
+
+'''
+-----------------------------------------------------
+# パイプラインのどこで時間がかかっているかを見るための計測
+各モジュールの重い処理 (decode, render, png, encode, readdir, spawn, wait) は
+profiling.stage(名前) で囲んであるので，enable() するだけで集計される．
+enable() していないときは何もしない context manager を返すだけ．
+
+    import profiling
+    profiling.enable(trace=True)
+    ...
+    print(profiling.report())
+    profiling.dump_json('/tmp/profile.json')
+    profiling.dump_chrome_trace('/tmp/trace.json')   # chrome://tracing や Perfetto で開く
+
+    with profiling.stage('myload'): ...              # 自分で区間を計る
+    @profiling.timed('infer')                        # 関数を丸ごと計る
+    profiling.count('cache_hit')                     # 回数だけ数える
+-----------------------------------------------------
+# 集計されるもの
+- stage ごとに count, total, min, max, mean [秒]，
+  hist (所要時間 [us] を 2 の冪で区切ったヒストグラム．キーは log2 の切り捨て)
+- count() で数えたカウンタ
+- trace=True のときは各区間の (名前, 開始, 長さ, スレッド) も記録する
+別プロセス (ParallelFrames, read_video_parallel など) の中の計測はそのプロセスに残る．
+-----------------------------------------------------
+'''
+
+_enabled = False
+_trace = False
+_lock = threading.Lock()
+_stats = {}
+_counters = {}
+_events = []
+_null = contextlib.nullcontext()
+
+
+def enable(trace=False):
+    global _enabled, _trace
+    _enabled = True
+    _trace = trace
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def reset():
+    with _lock:
+        _stats.clear()
+        _counters.clear()
+        _events.clear()
+
+
+def record(name, start, end):
+    duration = end-start
+    with _lock:
+        stat = _stats.get(name)
+        if stat is None:
+            stat = _stats[name] = {'count':0, 'total':0.0, 'min':math.inf, 'max':0.0, 'hist':{}}
+        stat['count'] += 1
+        stat['total'] += duration
+        stat['min'] = min(stat['min'],duration)
+        stat['max'] = max(stat['max'],duration)
+        bucket = int(math.log2(max(duration*1e6,1.0)))
+        stat['hist'][bucket] = stat['hist'].get(bucket,0)+1
+        if _trace:
+            _events.append((name,start,duration,threading.get_ident()))
+
+
+class _Stage:
+    __slots__ = ('name','start')
+    def __init__(self, name):
+        self.name = name
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *args):
+        record(self.name, self.start, time.perf_counter())
+
+
+def stage(name):
+    return _Stage(name) if _enabled else _null
+
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name,0)+n
+
+
+def report():
+    with _lock:
+        stages = { name: {**stat, 'mean': stat['total']/stat['count'], 'hist': dict(sorted(stat['hist'].items()))}
+                    for name,stat in _stats.items() }
+        return {'stages': stages, 'counters': dict(_counters)}
+
+def dump_json(path):
+    with open(path,'w') as f:
+        json.dump(report(), f, indent=2)
+
+def dump_chrome_trace(path):
+    pid = os.getpid()
+    with _lock:
+        events = [ {'name':name, 'ph':'X', 'ts':start*1e6, 'dur':duration*1e6, 'pid':pid, 'tid':tid}
+                    for name,start,duration,tid in _events ]
+    with open(path,'w') as f:
+        json.dump({'traceEvents':events}, f)
@@ -2,7 +2,25 @@
 from pathlib import Path
 import subprocess
 import tempfile
+import collections
+import threading
+import select
+import shlex
+import queue
+import signal
+import resource
+import shutil
+import hashlib
+import json
+import time
 import os
+import sys
+
+# パッケージ (pysnippets) としても，このディレクトリでスクリプトとしても使えるように
+try:
+    from . import profiling
+except ImportError:
+    import profiling
 
 # subprocess.run    : subprocess.{call, check_call, check_output} のまとめ、コマンド終了を待つ
 # subprocess.popen  : コマンド終了を待たない。 subprocess.run の基底
@@ -32,90 +50,549 @@ import os
 # 3.8 でも直っている
 # 3.6 以降なら
 
+# rusage=True なら戻り値の最後に資源使用量の dict が付く (下の RusagePopen のところを参照)
+
 # パイプできないコマンド
-def basic_command( command ):
-    result = subprocess.run( command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return result.stdout.decode()
+def basic_command( command, rusage=False ):
+    start = time.perf_counter()
+    result = run_rusage( command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = result.stdout.decode()
+    return with_usage(output, command, start, result.rusage) if rusage else output
 
 
-def basic_command_env( command, env ):
-    result = subprocess.run( command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
-    return result.stdout.decode()
+def basic_command_env( command, env, rusage=False ):
+    start = time.perf_counter()
+    result = run_rusage( command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    output = result.stdout.decode()
+    return with_usage(output, command, start, result.rusage) if rusage else output
 
 
 # コマンドがエラーにならない、必ず終了する前提
-def bash_command( command ):
+def bash_command( command, rusage=False ):
+    start = time.perf_counter()
     with tempfile.NamedTemporaryFile('w') as f:
         Path(f.name).write_text(command)
-        result = subprocess.run( ['bash',f.name],
+        result = run_rusage( ['bash',f.name],
                     stdout=subprocess.PIPE, stderr=subprocess.PIPE,check=True)
-        return result.stdout.decode()
+        output = result.stdout.decode()
+    return with_usage(output, command, start, result.rusage) if rusage else output
 
 # コマンドがエラーでも構わない、stdout も stderr も出力する
-def bash_command_except( command ):
+def bash_command_except( command, rusage=False ):
+    start = time.perf_counter()
     try:
         with tempfile.NamedTemporaryFile('w') as f:
             Path(f.name).write_text(command)
-            result = subprocess.run( ['bash',f.name],
+            result = run_rusage( ['bash',f.name],
                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,check=True)
-            return 0, result.stdout.decode(), result.stderr.decode()
+            output = 0, result.stdout.decode(), result.stderr.decode()
     # コマンドが失敗したとき
     except subprocess.CalledProcessError as e:
-        return 1, e.stdout.decode(), e.stderr.decode()
+        result = e
+        output = 1, e.stdout.decode(), e.stderr.decode()
+    return with_usage(output, command, start, result.rusage) if rusage else output
 
 
-def bash_command_env( command, env ):
+def bash_command_env( command, env, rusage=False ):
+    start = time.perf_counter()
     try:
         with tempfile.NamedTemporaryFile('w') as f:
             Path(f.name).write_text(command)
-            result = subprocess.run( ['bash',f.name],
+            result = run_rusage( ['bash',f.name],
                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,check=True,env=env,encoding='utf8')
-            return result.stdout#.decode()
+            output = result.stdout#.decode()
     # コマンドが失敗したとき
     except subprocess.CalledProcessError as e:
-        return e.stderr#.decode()
+        result = e
+        output = e.stderr#.decode()
+    return with_usage(output, command, start, result.rusage) if rusage else output
 
 
 
-def bash_command_timeoutable( command, limit ):
+def bash_command_timeoutable( command, limit, rusage=False ):
 
     print(limit)
+    start = time.perf_counter()
     try:
         with tempfile.NamedTemporaryFile('w') as f:
             Path(f.name).write_text(command)
-            result = subprocess.run( ['bash',f.name],
+            result = run_rusage( ['bash',f.name],
                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,check=True,timeout=limit)
-        return result.stdout.decode()
+        output = result.stdout.decode()
     # コマンドが失敗したとき
     except subprocess.CalledProcessError as e:
-        return e.stderr.decode()
+        result = e
+        output = e.stderr.decode()
     # コマンドが終了しないとき
+    # 途中までの出力は e.stdout, e.stderr に入っている
     except subprocess.TimeoutExpired as e:
-        print(e.stdout)
-        return -1, "", ""
+        result = e
+        output = -1, (e.stdout or b'').decode(), (e.stderr or b'').decode()
+    return with_usage(output, command, start, result.rusage) if rusage else output
 
 
-def basic_command_timeoutable( command, limit ):
+def basic_command_timeoutable( command, limit, rusage=False ):
+    start = time.perf_counter()
     try:
-        result = subprocess.run( command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=limit)
-        return result.stdout.decode()
+        result = run_rusage( command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=limit)
+        output = result.stdout.decode()
+    # 途中までの出力は e.stdout, e.stderr に入っている
     except subprocess.TimeoutExpired as e:
-        print(e.stdout)
-        return -1, "", ""
+        result = e
+        output = -1, (e.stdout or b'').decode(), (e.stderr or b'').decode()
+    return with_usage(output, command, start, result.rusage) if rusage else output
     
 
+# 資源使用量の計測
+# 子プロセスを os.wait4 で回収すると，その子 (と子が wait した孫以下) の rusage が取れる．
+# Popen は内部で os.waitpid しているので，そこだけ os.wait4 に差し替える．
+# rusage=True を渡した runner は戻り値の最後に次の dict を付けて返し，usage_stats にも足す
+#   command, wall_sec, user_sec, sys_sec, maxrss_kb (ツリー内で一番大きいプロセスのもの), inblock, oublock
+# _try_wait は Popen の private メソッド (wait() から呼ばれる)．CPython 3.7 〜 3.13 で確認．
+# poll() は _try_wait を通らない (_internal_poll が直接 waitpid する) ので，
+# wait(timeout=0) で回収して rusage を取りこぼさないようにする
+class RusagePopen(subprocess.Popen):
+    rusage = None
+    def _try_wait(self, wait_flags):
+        try:
+            pid, sts, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return (self.pid, 0)
+        if pid != 0:
+            self.rusage = rusage
+        return (pid, sts)
+    def poll(self):
+        try:
+            return self.wait(timeout=0)
+        except subprocess.TimeoutExpired:
+            return None
+
+# subprocess.run の RusagePopen 版 (戻り値や例外に .rusage が付く)
+# timeout のときは run と同じく bash だけ kill して，プロセスの終了だけを待つ
+def run_rusage( args, timeout=None, check=False, **kwargs ):
+    with RusagePopen(args, **kwargs) as proc:
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired as e:
+            proc.kill()
+            proc.wait()
+            e.rusage = proc.rusage
+            raise
+    if check and proc.returncode:
+        e = subprocess.CalledProcessError(proc.returncode, args, stdout, stderr)
+        e.rusage = proc.rusage
+        raise e
+    result = subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+    result.rusage = proc.rusage
+    return result
+
+# 戻り値が tuple ならその最後に，そうでなければ ( 戻り値, dict ) にして資源使用量を付ける
+def with_usage( result, command, start, rusage ):
+    record = usage_record(command, start, rusage)
+    return result+(record,) if isinstance(result,tuple) else (result, record)
+
+def usage_record( command, start, rusage ):
+    record = { 'command': command, 'wall_sec': time.perf_counter()-start,
+                'user_sec': 0.0, 'sys_sec': 0.0, 'maxrss_kb': 0, 'inblock': 0, 'oublock': 0 }
+    if rusage is not None:
+        record.update( user_sec=rusage.ru_utime, sys_sec=rusage.ru_stime,
+                        # mac は bytes，linux は KB
+                        maxrss_kb=rusage.ru_maxrss//1024 if sys.platform == 'darwin' else rusage.ru_maxrss,
+                        inblock=rusage.ru_inblock, oublock=rusage.ru_oublock )
+    usage_stats.add(record)
+    return record
+
+# コマンドのパターン (既定では先頭の単語) ごとの集計
+class UsageStats:
+    def __init__(self, key=None):
+        self.key = key if key else (lambda command: (command.split() or [''])[0])
+        self.lock = threading.Lock()
+        self.stats = {}
+    def add(self, record):
+        with self.lock:
+            stat = self.stats.setdefault( self.key(record['command']),
+                        {'count':0, 'wall_sec':0.0, 'user_sec':0.0, 'sys_sec':0.0,
+                         'maxrss_kb':0, 'inblock':0, 'oublock':0} )
+            stat['count'] += 1
+            for k in ('wall_sec','user_sec','sys_sec','inblock','oublock'):
+                stat[k] += record[k]
+            stat['maxrss_kb'] = max(stat['maxrss_kb'], record['maxrss_kb'])
+    # 合計と 1 回あたりの平均 (cpu = user + sys)
+    def summary(self):
+        with self.lock:
+            return { key: {**stat, 'mean_wall_sec': stat['wall_sec']/stat['count'],
+                            'mean_cpu_sec': (stat['user_sec']+stat['sys_sec'])/stat['count']}
+                        for key,stat in self.stats.items() }
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+
+usage_stats = UsageStats()
+
+
 # 全対応、シングルプロセスならこれが正解
-def bash_command_x( command, timelimit=10, env=None ):
-    try:
-        with tempfile.NamedTemporaryFile('w') as f:
-            Path(f.name).write_text(command)
-            result = subprocess.run( ['bash',f.name],
+#   subprocess.run と同じことを Popen でやって，起動 (spawn) と待ち (wait) を分けて計測する
+#   rusage=True なら戻り値の最後に資源使用量の dict が付く
+def bash_command_x( command, timelimit=10, env=None, rusage=False ):
+    start = time.perf_counter()
+    with tempfile.NamedTemporaryFile('w') as f:
+        Path(f.name).write_text(command)
+        with profiling.stage('spawn'):
+            proc = RusagePopen( ['bash',f.name],
                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                        timeout=timelimit, encoding='utf8', env=env)
-        return ( False, result.returncode, result.stdout, result.stderr )
-    # コマンドが終了しないとき
-    except subprocess.TimeoutExpired as e:
-        return ( True, 1, "", "" )
+                        encoding='utf8', env=env, start_new_session=True)
+        with profiling.stage('wait'), proc:
+            try:
+                stdout, stderr = proc.communicate(timeout=timelimit)
+                result = ( False, proc.returncode, stdout, stderr )
+            # 途中までの出力は返す
+            # bash だけ kill すると，パイプを引き継いだ子 (sleep など) が終わるまで communicate が返らないので
+            # プロセスグループごと kill する
+            except subprocess.TimeoutExpired:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                # setsid などでグループから抜けた孫がパイプを握っていても待ち続けないように，
+                # そのときはそこまでに読めた分を返す
+                try:
+                    stdout, stderr = proc.communicate(timeout=1)
+                except subprocess.TimeoutExpired as e:
+                    stdout = (e.stdout or b'').decode('utf8','replace')
+                    stderr = (e.stderr or b'').decode('utf8','replace')
+                    proc.stdout.close()
+                    proc.stderr.close()
+                    proc.wait()
+                result = ( True, 1, stdout, stderr )
+    if rusage:
+        result += ( usage_record(command, start, proc.rusage), )
+    return result
+
+
+# 同じ結果になるコマンド (ffprobe, nproc, git rev-parse など) の結果のキャッシュ
+#   cache = CommandCache(Path('/tmp/command_cache'), maxsize=256, ttl=3600)
+#   cache.run('nproc')                                       # bash_command_x と同じ戻り値
+#   cache.run('ffprobe a.mp4', files=[Path('a.mp4')])        # a.mp4 が変わったら実行し直す
+# - キー : コマンド文字列，env_keys で指定した環境変数の値，カレントディレクトリ，
+#          files の (パス, mtime, サイズ)
+# - メモリ上の LRU (maxsize 個) → root を渡したときはディスク (JSON) の順に探す
+# - ttl 秒より古い結果は使わない．タイムアウトした結果はキャッシュしない
+# - invalidate(command, ...) で 1 件，invalidate() で全部消す
+class CommandCache:
+    def __init__(self, root=None, maxsize=256, ttl=None, env_keys=('PATH',)):
+        self.root = Path(root) if root is not None else None
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.env_keys = env_keys
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        if self.root is not None:
+            self.root.mkdir(parents=True,exist_ok=True)
+
+    def key(self, command, env=None, files=()):
+        env = os.environ if env is None else env
+        fingerprints = []
+        for path in files:
+            try:
+                stat = os.stat(path)
+                fingerprints += [(str(path), stat.st_mtime_ns, stat.st_size)]
+            except FileNotFoundError:
+                fingerprints += [(str(path), None, None)]
+        params = ( command, [(k, env.get(k)) for k in self.env_keys], os.getcwd(), fingerprints )
+        return hashlib.sha256(json.dumps(params).encode()).hexdigest()
+
+    def _fresh(self, entry):
+        return self.ttl is None or time.time()-entry['time'] <= self.ttl
+
+    def get(self, key):
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if self._fresh(entry):
+                    self.memory.move_to_end(key)
+                    return tuple(entry['result'])
+                del self.memory[key]
+        if self.root is not None:
+            try:
+                entry = json.loads((self.root/(key+'.json')).read_text())
+            except (FileNotFoundError, ValueError):
+                return None
+            if self._fresh(entry):
+                self._remember(key, entry)
+                return tuple(entry['result'])
+        return None
+
+    def _remember(self, key, entry):
+        with self.lock:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.maxsize:
+                self.memory.popitem(last=False)
+
+    def put(self, key, result):
+        entry = {'time': time.time(), 'result': list(result)}
+        self._remember(key, entry)
+        if self.root is not None:
+            path = self.root/(key+'.json')
+            tmp = path.with_name('%s.%d.%d.tmp'%(key,os.getpid(),threading.get_ident()))
+            tmp.write_text(json.dumps(entry))
+            os.replace(tmp, path)
+
+    def run(self, command, timelimit=10, env=None, files=()):
+        key = self.key(command, env, files)
+        result = self.get(key)
+        if result is None:
+            result = bash_command_x(command, timelimit, env)
+            if not result[0]:
+                self.put(key, result)
+        return result
+
+    def invalidate(self, command=None, env=None, files=()):
+        if command is None:
+            with self.lock:
+                self.memory.clear()
+            if self.root is not None:
+                [ p.unlink() for p in self.root.glob('*.json') ]
+            return
+        key = self.key(command, env, files)
+        with self.lock:
+            self.memory.pop(key, None)
+        if self.root is not None:
+            try:
+                (self.root/(key+'.json')).unlink()
+            except FileNotFoundError:
+                pass
+
+
+# 出力を溜め込まない版 (ログを大量に出すコマンドや，止まってしまうコマンド向け)
+#   - stdout, stderr は 1 行ずつ on_stdout(line), on_stderr(line) に渡す
+#   - 手元に残すのは各ストリームの最後の tail 行だけ
+#   - 戻り値は bash_command_x と同じ ( timed_out, returncode, stdout, stderr ) で，
+#     stdout, stderr は最後の tail 行．タイムアウトしたときもそれまでの出力が入っている
+#   - タイムアウトしたらプロセスグループごと kill する
+#   - rusage=True なら戻り値の最後に資源使用量の dict が付く
+def bash_command_stream( command, timelimit=10, env=None, on_stdout=None, on_stderr=None, tail=1000,
+                            rusage=False ):
+    start = time.perf_counter()
+    tails = { 'stdout': collections.deque(maxlen=tail), 'stderr': collections.deque(maxlen=tail) }
+
+    # 見捨てた (abandoned) あとも EOF まで読み続けて，孫がパイプ詰まりで止まらないようにする
+    abandoned = threading.Event()
+    def pump( pipe, lines, callback ):
+        for line in iter(pipe.readline, ''):
+            if abandoned.is_set():
+                continue
+            lines.append(line)
+            if callback is not None:
+                callback(line)
+        pipe.close()
+
+    with tempfile.NamedTemporaryFile('w') as f:
+        Path(f.name).write_text(command)
+        proc = RusagePopen( ['bash',f.name],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    encoding='utf8', errors='replace', env=env, start_new_session=True )
+        readers = [ threading.Thread(target=pump, args=(proc.stdout,tails['stdout'],on_stdout), daemon=True),
+                    threading.Thread(target=pump, args=(proc.stderr,tails['stderr'],on_stderr), daemon=True) ]
+        [ reader.start() for reader in readers ]
+        try:
+            proc.wait(timeout=timelimit)
+            timed_out = False
+        # コマンドが終了しないとき
+        except subprocess.TimeoutExpired:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            proc.wait()
+            timed_out = True
+        # setsid などでグループから抜けた孫がパイプを握っていても待ち続けないように，
+        # タイムアウトしたときは少しだけ待って，そこまでの tail を返す
+        # (readline 中のパイプは別スレッドから close できないので，読み込みスレッドは置いていく)
+        deadline = time.monotonic()+1
+        [ reader.join(max(0,deadline-time.monotonic()) if timed_out else None) for reader in readers ]
+        abandoned.set()
+    returncode = 1 if timed_out else proc.returncode
+    result = ( timed_out, returncode, ''.join(list(tails['stdout'])), ''.join(list(tails['stderr'])) )
+    if rusage:
+        result += ( usage_record(command, start, proc.rusage), )
+    return result
+
+
+# bash_command_x を大量に並列で実行する (asyncio)
+#   - 同時に動かすのは concurrency 個まで
+#   - timelimit を超えたコマンドはプロセスグループごと kill する (子や孫も残らない)
+#   - 戻り値は ( results, stats )
+#       results : ordered=True なら commands と同じ順の ( timed_out, returncode, stdout, stderr ) の list
+#                 ordered=False なら終わった順の ( commands の index, 結果 ) の list
+#                 (タイムアウトしたときもそれまでの出力が入っている)
+#       stats   : commands (個数), timed_out (個数), wall_sec, per_sec (1 秒あたりのコマンド数),
+#                 user_sec, sys_sec (この間に回収した子プロセス全体の CPU 時間．RUSAGE_CHILDREN の差分なので
+#                 同時に別のスレッドで終わった子プロセスの分も入る．コマンドごとの値は取れない)
+# すでにイベントループの中にいるときは await run_many_async(...) を使う
+async def run_many_async( commands, concurrency=8, timelimit=10, env=None, ordered=True ):
+    import asyncio
+    semaphore = asyncio.Semaphore(concurrency)
+    done = []
+
+    # communicate() は途中で止めると読んだ分が失われるので，自分で溜める
+    async def drain( stream, chunks ):
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+    async def run_one( idx, command ):
+        async with semaphore:
+            with tempfile.NamedTemporaryFile('w') as f:
+                Path(f.name).write_text(command)
+                proc = await asyncio.create_subprocess_exec( 'bash', f.name,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            env=env, start_new_session=True )
+                stdout, stderr = [], []
+                task = asyncio.gather( drain(proc.stdout,stdout), drain(proc.stderr,stderr), proc.wait() )
+                finished, _ = await asyncio.wait([task], timeout=timelimit)
+                timed_out = not finished
+                # コマンドが終了しないとき (それまでの出力は返す)
+                if timed_out:
+                    try:
+                        os.killpg(proc.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    # setsid などでグループから抜けた孫がパイプを握っていても待ち続けない
+                    finished, _ = await asyncio.wait([task], timeout=1)
+                    if not finished:
+                        task.cancel()
+                        try:
+                            await task
+                        except asyncio.CancelledError:
+                            pass
+                        # パイプを閉じる (Process には公開の close がないので transport を閉じる)
+                        proc._transport.close()
+                result = ( timed_out, 1 if timed_out else proc.returncode,
+                            b''.join(stdout).decode(), b''.join(stderr).decode() )
+        done.append((idx,result))
+        return result
+
+    start = time.perf_counter()
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    results = await asyncio.gather(*[ run_one(idx,command) for idx,command in enumerate(commands) ])
+    wall = time.perf_counter()-start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    stats = { 'commands': len(results), 'timed_out': sum(r[0] for r in results),
+                'wall_sec': wall, 'per_sec': len(results)/wall if wall > 0 else 0.0,
+                'user_sec': after.ru_utime-before.ru_utime, 'sys_sec': after.ru_stime-before.ru_stime }
+    return ( results if ordered else done, stats )
+
+def run_many( commands, concurrency=8, timelimit=10, env=None, ordered=True ):
+    import asyncio
+    return asyncio.run(run_many_async( commands, concurrency, timelimit, env, ordered ))
+
+
+# 常駐 bash のプール (小さいコマンドを大量に実行するとき向け)
+# bash_command_x は毎回 一時ファイル作成 + bash の起動 をするので，小さいコマンドではそちらの方が重い．
+# BashPool は bash を size 個起動しっぱなしにしておき，スクリプトをパイプで送る．
+#   - プロトコル : スクリプトを NUL 終端で送る → ワーカーは ( eval ) のサブシェルで実行 →
+#                  終了コードを 1 行で返す．stdout/stderr はワーカーごとのファイルに書かせて読む
+#   - サブシェルで実行するので，cd や export は次のコマンドに残らない
+#   - env を渡すとサブシェル内で環境変数を全部消してから設定する．cwd はサブシェル内で cd
+#     env に PATH がなければ，新しく起動した bash と同じく bash の既定の PATH を (export せずに) 使う
+#   - ワーカー自身のシェル変数 (出力先など) はコマンドを実行する前にサブシェル内で消す
+#   - timelimit を超えたらワーカーをプロセスグループごと kill して起動し直す (それまでの出力は返す)
+#   - 戻り値は bash_command_x と同じ ( timed_out, returncode, stdout, stderr )
+#   - rusage は取らない．コマンドはワーカーの ( ) サブシェルで動き，それを wait するのはワーカーの bash なので，
+#     こちらの wait4 や RUSAGE_CHILDREN には (ワーカーを kill して回収するまで) 現れない
+#   with BashPool(4) as pool:
+#       pool.run('nproc')
+class BashPool:
+    driver = '''
+        out="$1"; err="$2"; set --
+        default_path=$(env -i "$BASH" -c 'printf %s "$PATH"')
+        while IFS= read -r -d '' script; do
+            ( eval "$script" ) >"$out" 2>"$err" </dev/null
+            printf '%d\\n' "$?"
+        done
+    '''
+    driver_vars = 'out err default_path script'
+
+    def __init__(self, size=4):
+        self.root = Path(tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None))
+        self.idle = queue.Queue()
+        for i in range(size):
+            self.idle.put(self._start(i))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _start(self, i):
+        out, err = self.root/('%d.out'%i), self.root/('%d.err'%i)
+        proc = subprocess.Popen( ['bash','-c',self.driver,'bash',str(out),str(err)],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, start_new_session=True )
+        return (i, proc, out, err)
+
+    def _kill(self, proc):
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+        proc.stdin.close()
+        proc.stdout.close()
+
+    def close(self):
+        while True:
+            try:
+                _, proc, _, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._kill(proc)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def run(self, command, timelimit=10, env=None, cwd=None):
+        prelude = ''
+        if cwd is not None:
+            prelude += 'cd -- %s || exit 1\n'%shlex.quote(str(cwd))
+        if env is not None:
+            prelude += 'unset $(compgen -e) 2>/dev/null\n'
+            if 'PATH' not in env:
+                prelude += 'PATH=$default_path\n'
+            prelude += ''.join('export %s=%s\n'%(k,shlex.quote(v)) for k,v in env.items())
+        # eval する文字列は展開済みなので，script ごと消してよい
+        prelude += 'unset %s\n'%self.driver_vars
+        i, proc, out, err = self.idle.get()
+        deadline = time.monotonic()+timelimit
+        try:
+            proc.stdin.write((prelude+command).encode()+b'\0')
+            proc.stdin.flush()
+            # 終了コードの行を待つ
+            line = b''
+            while not line.endswith(b'\n'):
+                remain = deadline-time.monotonic()
+                if remain <= 0 or not select.select([proc.stdout],[],[],remain)[0]:
+                    break
+                chunk = os.read(proc.stdout.fileno(), 64)
+                if not chunk:
+                    break
+                line += chunk
+        except BrokenPipeError:
+            line = b''
+        stdout = out.read_bytes().decode('utf8','replace') if out.exists() else ''
+        stderr = err.read_bytes().decode('utf8','replace') if err.exists() else ''
+        if line.endswith(b'\n'):
+            self.idle.put((i, proc, out, err))
+            return ( False, int(line), stdout, stderr )
+        # 止まった，または死んだワーカーは起動し直す
+        # (パイプの EOF はワーカーを回収できるより先に見えるので，poll() ではなく期限で判定する)
+        timed_out = time.monotonic() >= deadline
+        self._kill(proc)
+        self.idle.put(self._start(i))
+        if not timed_out:
+            raise RuntimeError('bash worker died')
+        return ( True, 1, stdout, stderr )
 
 
 def main():